@@ -24,5 +24,11 @@ OVERRIDE_LOGGING = logging.getLevelName(os.environ.get("OVERRIDE_LOGGING", "WARN
 
 EXTRA_USERS = os.environ.get("EXTRA_USERS", "").split(",")
 
+MAX_CONCURRENT_WEBHOOKS = int(os.environ.get("MAX_CONCURRENT_WEBHOOKS", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+
+HTTP_CACHE_SIZE = int(os.environ.get("HTTP_CACHE_SIZE", "5000"))
+HTTP_CACHE_TTL = int(os.environ.get("HTTP_CACHE_TTL", "300"))
+
 
 STERILE = os.environ.get("STERILE") == "true"
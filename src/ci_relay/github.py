@@ -1,7 +1,9 @@
-import hmac
+import asyncio
+import functools
 from typing import Any, Mapping
 import json
 import gidgethub
+import io
 import textwrap
 
 from gidgethub.routing import Router
@@ -13,6 +15,24 @@ from gidgetlab.abc import GitLabAPI
 import aiohttp
 
 from ci_relay import config, gitlab
+from ci_relay.signature import trigger_signature
+
+
+# actions the router acts on, other actions of these events are dropped
+# before any API calls are made for them
+HANDLED_ACTIONS = {
+    "pull_request": frozenset(
+        {"synchronize", "opened", "reopened", "ready_for_review"}
+    ),
+    "check_run": frozenset({"rerequested"}),
+    # "requested" is not handled
+    "check_suite": frozenset({"rerequested"}),
+}
+
+
+def is_handled_event(event: Event) -> bool:
+    actions = HANDLED_ACTIONS.get(event.event)
+    return actions is None or event.data.get("action") in actions
 
 
 def create_router():
@@ -35,35 +55,69 @@ def create_router():
         repo_url = event.data["repository"]["url"]
         logger.debug("Repo url is %s", repo_url)
 
-        if action not in ("synchronize", "opened", "reopened", "ready_for_review"):
+        if action not in HANDLED_ACTIONS["pull_request"]:
             return
 
-        return await handle_synchronize(gh, app.ctx.aiohttp_session, event.data, gl=gl)
+        return await coalesce(
+            app,
+            # push and synchronize check different things, only join the
+            # same kind of event
+            ("pull_request", pr["base"]["repo"]["full_name"], pr["head"]["sha"]),
+            handle_synchronize,
+            gh,
+            app.ctx.aiohttp_session,
+            event.data,
+            gl=gl,
+        )
 
     @router.register("check_run")
     async def on_check_run(event: Event, gh: GitHubAPI, app: Sanic, gl: GitLabAPI):
-        if event.data["action"] != "rerequested":
+        if event.data["action"] not in HANDLED_ACTIONS["check_run"]:
             return
         logger.debug("Received request for check rerun")
         await handle_rerequest(gh, app.ctx.aiohttp_session, event.data)
 
     @router.register("check_suite")
     async def on_check_suite(event: Event, gh: GitHubAPI, app: Sanic, gl: GitLabAPI):
-        if event.data["action"] not in (
-            #  "requested",
-            "rerequested",
-        ):
+        if event.data["action"] not in HANDLED_ACTIONS["check_suite"]:
             return
         await handle_check_suite(gh, app.ctx.aiohttp_session, event.data, gl=gl)
 
     @router.register("push")
     async def on_push(event: Event, gh: GitHubAPI, app: Sanic, gl: GitLabAPI):
         logger.debug("Received push event")
-        await handle_push(gh, app.ctx.aiohttp_session, event.data, gl=gl)
+        await coalesce(
+            app,
+            ("push", event.data["repository"]["full_name"], event.data["after"]),
+            handle_push,
+            gh,
+            app.ctx.aiohttp_session,
+            event.data,
+            gl=gl,
+        )
 
     return router
 
 
+async def coalesce(app: Sanic, key, func, *args, **kwargs):
+    # concurrent calls with the same key wait for the first one instead of
+    # repeating its work
+    inflight = app.ctx.inflight
+    task = inflight.get(key)
+    if task is not None:
+        logger.debug("Joining in-flight processing for %s", key)
+        # a cancelled joiner must not cancel the owner's work
+        return await asyncio.shield(task)
+
+    task = asyncio.create_task(func(*args, **kwargs))
+    inflight[key] = task
+    try:
+        return await task
+    finally:
+        if inflight.get(key) is task:
+            del inflight[key]
+
+
 async def get_installed_repos(gh: GitHubAPI) -> dict[str, Any]:
     return await gh.getitem("/installation/repositories")
 
@@ -92,9 +146,9 @@ async def add_rejection_status(gh: GitHubAPI, head_sha, repo_url):
     }
 
     logger.debug(
-        "Posting check run status for sha %s to GitHub: %s",
+        "Posting check run status for sha %s to GitHub: %s/check-runs",
         head_sha,
-        f"{repo_url}/check-runs",
+        repo_url,
     )
     if not config.STERILE:
         await gh.post(f"{repo_url}/check-runs", data=payload)
@@ -114,14 +168,15 @@ async def add_failure_status(gh: GitHubAPI, head_sha, repo_url, message):
     }
 
     logger.debug(
-        "Posting check run status for sha %s to GitHub: %s",
+        "Posting check run status for sha %s to GitHub: %s/check-runs",
         head_sha,
-        f"{repo_url}/check-runs",
+        repo_url,
     )
     if not config.STERILE:
         await gh.post(f"{repo_url}/check-runs", data=payload)
 
 
+@functools.lru_cache(maxsize=1024)
 def make_repo_slug(full_name: str) -> str:
     return full_name.replace("/", "_")
 
@@ -193,22 +248,18 @@ async def handle_check_suite(
     project_id = job_data["pipeline"]["project_id"]
 
     pipeline_vars = await gitlab.get_pipeline_variables(
-        project_id, pipeline_id, session
+        project_id, pipeline_id, session=session
     )
 
-    bridge_payload = pipeline_vars["BRIDGE_PAYLOAD"]
+    # encode once, both the HMAC and the JSON decode work on the bytes
+    raw_payload = pipeline_vars["BRIDGE_PAYLOAD"].encode()
     signature = pipeline_vars["TRIGGER_SIGNATURE"]
 
-    expected_signature = hmac.new(
-        config.TRIGGER_SECRET,
-        bridge_payload.encode(),
-        digestmod="sha512",
-    ).hexdigest()
-    if not hmac.compare_digest(expected_signature, signature):
+    if not await trigger_signature.verify_async(raw_payload, signature):
         logger.error("Signatures do not match for pipeline behind check suite")
         raise ValueError("Signature mismatch")
 
-    bridge_payload = json.loads(bridge_payload)
+    bridge_payload = json.loads(raw_payload)
 
     clone_url = bridge_payload["clone_url"]
     head_sha = bridge_payload["head_sha"]
@@ -348,33 +399,54 @@ async def get_author_in_team(gh: GitHubAPI, author: str, org: str) -> bool:
     return False
 
 
+# bounds concurrent GitLab requests when checking for redundant pipelines
+_cancel_semaphore = asyncio.Semaphore(20)
+
+
 async def cancel_pipelines_if_redundant(gl: GitLabAPI, head_ref: str, clone_url: str):
     logger.debug("Checking for redundant pipelines")
+    pipeline_ids = []
     for scope in ["running", "pending"]:
+        # all bridge pipelines run on the same ref, so filter on the trigger
+        # source server-side; only those carry HEAD_REF and CLONE_URL
         async for pipeline in gl.getiter(
-            f"/projects/{config.GITLAB_PROJECT_ID}/pipelines", {"scope": scope}
+            f"/projects/{config.GITLAB_PROJECT_ID}/pipelines",
+            {"scope": scope, "source": "trigger"},
         ):
-            variables = {}
-            for item in await gl.getitem(
-                f"/projects/{config.GITLAB_PROJECT_ID}/pipelines/{pipeline['id']}/variables"
-            ):
-                variables[item["key"]] = item["value"]
-
-            if (
-                variables["HEAD_REF"] == head_ref
-                and variables["CLONE_URL"] == clone_url
-            ):
-                logger.debug(
-                    "Cancel pipeline %d for %s on %s",
-                    pipeline["id"],
-                    head_ref,
-                    clone_url,
-                )
-                if not config.STERILE:
-                    await gl.post(
-                        f"/projects/{config.GITLAB_PROJECT_ID}/pipelines/{pipeline['id']}/cancel",
-                        data=None,
-                    )
+            pipeline_ids.append(pipeline["id"])
+
+    async def get_variables(pipeline_id):
+        async with _cancel_semaphore:
+            items = await gl.getitem(
+                f"/projects/{config.GITLAB_PROJECT_ID}/pipelines/{pipeline_id}/variables"
+            )
+        return {item["key"]: item["value"] for item in items}
+
+    async def cancel(pipeline_id):
+        async with _cancel_semaphore:
+            await gl.post(
+                f"/projects/{config.GITLAB_PROJECT_ID}/pipelines/{pipeline_id}/cancel",
+                data=None,
+            )
+
+    all_variables = await asyncio.gather(*map(get_variables, pipeline_ids))
+
+    to_cancel = []
+    for pipeline_id, variables in zip(pipeline_ids, all_variables):
+        if (
+            variables.get("HEAD_REF") == head_ref
+            and variables.get("CLONE_URL") == clone_url
+        ):
+            logger.debug(
+                "Cancel pipeline %d for %s on %s",
+                pipeline_id,
+                head_ref,
+                clone_url,
+            )
+            to_cancel.append(pipeline_id)
+
+    if not config.STERILE:
+        await asyncio.gather(*map(cancel, to_cancel))
 
 
 async def handle_synchronize(
@@ -441,8 +513,9 @@ async def trigger_pipeline(
     head_ref: str,
 ):
     logger.debug(
-        "Getting url for CI config from %s",
-        f"{repo_url}/contents/.gitlab-ci.yml?ref={head_sha}",
+        "Getting url for CI config from %s/contents/.gitlab-ci.yml?ref=%s",
+        repo_url,
+        head_sha,
     )
 
     ci_config_file = await gh.getitem(
@@ -460,9 +533,7 @@ async def trigger_pipeline(
     }
     payload = json.dumps(data)
 
-    signature = hmac.new(
-        config.TRIGGER_SECRET, payload.encode(), digestmod="sha512"
-    ).hexdigest()
+    signature = trigger_signature.create(payload)
 
     logger.debug("Triggering pipeline on gitlab")
     if not config.STERILE:
@@ -497,23 +568,26 @@ async def trigger_pipeline(
                 logger.debug("Triggered pipeline on gitlab")
 
 
+_gitlab_to_github_status = {
+    "created": "queued",
+    "waiting_for_resource": "queued",
+    "preparing": "queued",
+    "pending": "queued",
+    "manual": "queued",
+    "scheduled": "queued",
+    "running": "in_progress",
+    "success": "completed",
+    "failed": "completed",
+    "canceled": "completed",
+    "skipped": "completed",
+}
+
+
 def gitlab_to_github_status(gitlab_status: str) -> str:
-    if gitlab_status in (
-        "created",
-        "waiting_for_resource",
-        "preparing",
-        "pending",
-        "manual",
-        "scheduled",
-    ):
-        check_status = "queued"
-    elif gitlab_status in ("running",):
-        check_status = "in_progress"
-    elif gitlab_status in ("success", "failed", "canceled", "skipped"):
-        check_status = "completed"
-    else:
+    try:
+        return _gitlab_to_github_status[gitlab_status]
+    except KeyError:
         raise ValueError(f"Unknown status {gitlab_status}")
-    return check_status
 
 
 async def handle_pipeline_status(
@@ -549,20 +623,25 @@ async def handle_pipeline_status(
     started_at = job["started_at"]
     completed_at = job["finished_at"]
 
-    log = await gitlab.get_job_log(
-        project["id"], job["id"], session=app.ctx.aiohttp_session
+    github_limit = 65535 - 200  # tolerance
+
+    # the limit counts characters but the tail is sized in bytes, a UTF-8
+    # character takes at most four
+    log, total_lines = await gitlab.get_job_log_tail(
+        project["id"],
+        job["id"],
+        session=app.ctx.aiohttp_session,
+        max_size=4 * github_limit,
     )
 
-    github_limit = 65535 - 200  # tolerance
     logger.debug("Log length: %d (max %d)", len(log), github_limit)
 
     lines = log.split("\n")
 
-    if len(log) > github_limit:
+    if len(log) > github_limit or len(lines) < total_lines:
         selected_lines = []
         size = 0
-        rlines = list(reversed(lines))
-        for line in rlines:
+        for line in reversed(lines):
             if size + len(line) >= github_limit:
                 break
 
@@ -570,20 +649,22 @@ async def handle_pipeline_status(
             #  logger.debug("%d => %d", size, size + len(line))
             size += len(line) + 1  # +1 for newline
 
-        log = f"Showing last {len(selected_lines)} out of {len(lines)} total lines\n\n"
-        lines = list(reversed(selected_lines))
+        log = f"Showing last {len(selected_lines)} out of {total_lines} total lines\n\n"
+        selected_lines.reverse()
+        lines = selected_lines
     else:
         log = ""
 
-    raw_lines = lines
-    lines = []
-    for line in raw_lines:
+    buf = io.StringIO()
+    buf.write(log)
+    for i, line in enumerate(lines):
+        if i > 0:
+            buf.write("\n")
         if len(line) > 150:
-            lines.append(textwrap.fill(line, width=150))
-        else:
-            lines.append(line)
+            line = textwrap.fill(line, width=150)
+        buf.write(line)
 
-    log += "\n".join(lines)
+    log = buf.getvalue()
     logger.debug("Log is: %d characters", len(log))
 
     title = f"GitLab CI: {status.upper()}"
@@ -626,9 +707,9 @@ async def handle_pipeline_status(
     # repo_url = trigger["base"]["repo"]["url"]
 
     logger.debug(
-        "Posting check run status for sha %s to GitHub: %s",
+        "Posting check run status for sha %s to GitHub: %s/check-runs",
         head_sha,
-        f"{repo_url}/check-runs",
+        repo_url,
     )
 
     if not config.STERILE:
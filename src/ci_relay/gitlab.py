@@ -1,18 +1,62 @@
+import asyncio
+import collections
+import functools
 import re
+from typing import AsyncIterator
 
 import aiohttp
+import cachetools
 
 from ci_relay import config
 
 _default_headers = {"Private-Token": config.GITLAB_ACCESS_TOKEN}
 
-ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/ ]*[@-~])")
+ansi_escape = re.compile(rb"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+_ansi_sub = ansi_escape.sub
+
+
+# longest escape sequence carried over between trace chunks
+_MAX_CARRY = 32
+
+
+def strip_ansi(data: bytes) -> bytes:
+    # most traces are plain text: memchr for ESC before running the regex
+    if b"\x1b" not in data:
+        return data
+    return _ansi_sub(b"", data)
+
+
+def _cached(ttl: float, maxsize: int = 4096):
+    # TTL cache for GET helpers keyed on their positional arguments. The
+    # in-flight task is cached, so concurrent callers share one request.
+    def decorator(func):
+        cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+
+        def evict_failed(key, task):
+            if (task.cancelled() or task.exception() is not None) and cache.get(
+                key
+            ) is task:
+                del cache[key]
+
+        @functools.wraps(func)
+        async def wrapper(*args, session: aiohttp.ClientSession):
+            task = cache.get(args)
+            if task is None:
+                task = asyncio.ensure_future(func(*args, session=session))
+                task.add_done_callback(functools.partial(evict_failed, args))
+                cache[args] = task
+            return await asyncio.shield(task)
+
+        return wrapper
+
+    return decorator
 
 
 def get_pipeline_url(project_id: int, pipeline_id: int) -> str:
     return f"{config.GITLAB_API_URL}/projects/{project_id}/pipelines/{pipeline_id}"
 
 
+@_cached(ttl=30)
 async def get_pipeline(
     project_id: int, pipeline_id: int, session: aiohttp.ClientSession
 ):
@@ -35,16 +79,61 @@ async def get_job(project_id: int, job_id: int, session: aiohttp.ClientSession):
         return await resp.json()
 
 
-async def get_job_log(project_id: int, job_id: int, session: aiohttp.ClientSession):
+async def iter_job_log_clean(
+    project_id: int,
+    job_id: int,
+    session: aiohttp.ClientSession,
+    chunk_size: int = 64 * 1024,
+) -> AsyncIterator[bytes]:
+    carry = b""
     async with session.get(
         get_job_url(project_id, job_id) + "/trace", headers=_default_headers
     ) as resp:
         resp.raise_for_status()
-        text = await resp.text()
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            data = carry + chunk
+            # hold back an escape sequence that may continue in the next chunk
+            cut = data.rfind(b"\x1b", max(0, len(data) - _MAX_CARRY))
+            if cut == -1 or ansi_escape.match(data, cut) is not None:
+                cut = len(data)
+            carry = data[cut:]
+            yield strip_ansi(data[:cut])
 
-    return ansi_escape.sub("", text)
+    if carry:
+        yield strip_ansi(carry)
 
 
+async def get_job_log(project_id: int, job_id: int, session: aiohttp.ClientSession):
+    data = b"".join([c async for c in iter_job_log_clean(project_id, job_id, session)])
+    return data.decode(errors="replace")
+
+
+async def get_job_log_tail(
+    project_id: int, job_id: int, session: aiohttp.ClientSession, max_size: int
+) -> tuple[str, int]:
+    # only keep the tail in memory, but count all lines
+    chunks = collections.deque()
+    size = 0
+    total_size = 0
+    total_lines = 1
+    async for chunk in iter_job_log_clean(project_id, job_id, session):
+        total_lines += chunk.count(b"\n")
+        chunks.append(chunk)
+        size += len(chunk)
+        total_size += len(chunk)
+        while size - len(chunks[0]) >= max_size:
+            size -= len(chunks.popleft())
+
+    data = b"".join(chunks)
+    if total_size > max_size:
+        # drop the partial first line
+        data = data[-max_size:]
+        data = data[data.find(b"\n") + 1 :]
+
+    return data.decode(errors="replace"), total_lines
+
+
+@_cached(ttl=24 * 60 * 60)
 async def get_pipeline_variables(
     project_id: int, pipeline_id: int, session: aiohttp.ClientSession
 ):
@@ -61,6 +150,7 @@ async def get_pipeline_variables(
     return output
 
 
+@_cached(ttl=60 * 60)
 async def get_project(project_id: int, session: aiohttp.ClientSession):
     full_pipeline_url = f"{config.GITLAB_API_URL}/projects/{project_id}"
 
@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+import hmac
+import re
+
+from ci_relay import config
+
+# payloads above this size are hashed in a worker thread
+OFFLOAD_THRESHOLD = 64 * 1024
+
+# signatures are lowercase hexdigests of SHA-512
+_signature_format = re.compile(r"[0-9a-f]{128}")
+
+
+class Signature:
+    def __init__(self, secret: bytes):
+        self.secret = secret
+        # keyed once, copied per message to skip the key schedule
+        self._template = hmac.new(secret, digestmod=hashlib.sha512)
+
+    def _digest(self, payload: str | bytes) -> bytes:
+        if isinstance(payload, str):
+            payload = payload.encode()
+        h = self._template.copy()
+        h.update(payload)
+        return h.digest()
+
+    def create(self, payload: str | bytes) -> str:
+        return self._digest(payload).hex()
+
+    def verify(self, payload: str | bytes, signature: str) -> bool:
+        # bytes.fromhex would also accept upper case and whitespace
+        if _signature_format.fullmatch(signature) is None:
+            return False
+        return hmac.compare_digest(self._digest(payload), bytes.fromhex(signature))
+
+    async def verify_async(self, payload: str | bytes, signature: str) -> bool:
+        if len(payload) < OFFLOAD_THRESHOLD:
+            return self.verify(payload, signature)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.verify, payload, signature
+        )
+
+
+trigger_signature = Signature(config.TRIGGER_SECRET)
@@ -2,6 +2,7 @@ import hmac
 
 from sanic import Sanic, SanicException, response
 import aiohttp
+import gidgethub
 from gidgethub import sansio
 from gidgethub.apps import get_installation_access_token, get_jwt
 from gidgethub import aiohttp as gh_aiohttp
@@ -10,29 +11,110 @@ from sanic.log import logger
 import cachetools
 import json
 import asyncio
-from aiolimiter import AsyncLimiter
+import time
+from datetime import datetime, timezone
+import dateutil.parser
 
 from ci_relay import config, gitlab
-from ci_relay.github import create_router, get_installed_repos, handle_pipeline_status
+from ci_relay.github import (
+    coalesce,
+    create_router,
+    get_installed_repos,
+    handle_pipeline_status,
+    is_handled_event,
+)
+from ci_relay.signature import trigger_signature
+
+
+# how long a health check result is reused before probing again
+HEALTH_CACHE_TTL = 5.0
+
+# how long shutdown waits for queued webhooks before cancelling the workers
+WEBHOOK_DRAIN_TIMEOUT = 10.0
+
+# startup does not wait longer than this for the GitLab connection warm-up
+GITLAB_WARMUP_TIMEOUT = 5.0
+
+
+class TokenBucket:
+    # handlers all run on the event loop thread, so no locking is needed
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def get_app_jwt(app):
+    # app JWTs are valid for 10 minutes, re-sign after 8
+    cached = app.ctx.app_jwt
+    if cached is not None and time.monotonic() < cached[1]:
+        return cached[0]
+
+    jwt = get_jwt(app_id=app.config.APP_ID, private_key=app.config.PRIVATE_KEY)
+    app.ctx.app_jwt = (jwt, time.monotonic() + 8 * 60)
+    return jwt
+
+
+async def get_installation_token(app, installation_id):
+    # installation tokens are valid for an hour, reuse them until shortly
+    # before they expire
+    cached = app.ctx.installation_tokens.get(installation_id)
+    if cached is not None and cached[1] - time.monotonic() > 60:
+        return cached[0]
+
+    lock = app.ctx.installation_token_locks.setdefault(installation_id, asyncio.Lock())
+    async with lock:
+        cached = app.ctx.installation_tokens.get(installation_id)
+        if cached is not None and cached[1] - time.monotonic() > 60:
+            return cached[0]
+
+        gh_pre = gh_aiohttp.GitHubAPI(app.ctx.aiohttp_session, __name__)
+        access_token_response = await get_installation_access_token(
+            gh_pre,
+            installation_id=installation_id,
+            app_id=app.config.APP_ID,
+            private_key=app.config.PRIVATE_KEY,
+        )
+
+        token = access_token_response["token"]
+        expires_at = dateutil.parser.isoparse(access_token_response["expires_at"])
+        lifetime = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        app.ctx.installation_tokens[installation_id] = (
+            token,
+            time.monotonic() + lifetime,
+        )
+        # callers still waiting on this lock find the token in the cache, so
+        # the lock is no longer needed
+        app.ctx.installation_token_locks.pop(installation_id, None)
+        return token
 
 
 async def client_for_installation(app, installation_id):
-    gh_pre = gh_aiohttp.GitHubAPI(app.ctx.aiohttp_session, __name__)
-    access_token_response = await get_installation_access_token(
-        gh_pre,
-        installation_id=installation_id,
-        app_id=app.config.APP_ID,
-        private_key=app.config.PRIVATE_KEY,
-    )
+    token = await get_installation_token(app, installation_id)
 
-    token = access_token_response["token"]
+    # reuse the client for as long as its token is current
+    cached = app.ctx.installation_clients.get(installation_id)
+    if cached is not None and cached[0] == token:
+        return cached[1]
 
-    return gh_aiohttp.GitHubAPI(
+    gh = gh_aiohttp.GitHubAPI(
         app.ctx.aiohttp_session,
         __name__,
         oauth_token=token,
         cache=app.ctx.cache,
     )
+    app.ctx.installation_clients[installation_id] = (token, gh)
+    return gh
 
 
 def create_app():
@@ -41,70 +123,135 @@ def create_app():
     app.update_config(config)
     logger.setLevel(config.OVERRIDE_LOGGING)
 
-    app.ctx.cache = cachetools.LRUCache(maxsize=500)
+    app.ctx.cache = cachetools.TTLCache(
+        maxsize=config.HTTP_CACHE_SIZE, ttl=config.HTTP_CACHE_TTL
+    )
     app.ctx.github_router = create_router()
-
-    limiter = AsyncLimiter(10)
+    app.ctx.inflight = {}
+    app.ctx.health_cache = None
+    app.ctx.app_jwt = None
+    app.ctx.bridge_payloads = cachetools.LRUCache(maxsize=2048)
+    # entries also carry their own deadline, the TTL just bounds memory
+    app.ctx.installation_tokens = cachetools.TTLCache(maxsize=1024, ttl=60 * 60)
+    app.ctx.installation_token_locks = {}
+    app.ctx.installation_clients = cachetools.LRUCache(maxsize=1024)
+    app.ctx.webhook_queue = asyncio.Queue(maxsize=config.WEBHOOK_QUEUE_SIZE)
+    # secrets are checked on every webhook, resolve them once
+    app.ctx.webhook_secret = app.config.WEBHOOK_SECRET
+    app.ctx.gitlab_webhook_secret = config.GITLAB_WEBHOOK_SECRET.encode()
+
+    # 10 health checks per minute
+    limiter = TokenBucket(capacity=10, rate=10 / 60)
 
     @app.listener("before_server_start")
     async def init(app, loop):
         logger.debug("Creating aiohttp session")
-        app.ctx.aiohttp_session = aiohttp.ClientSession(loop=loop)
+        app.ctx.aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=30,
+                enable_cleanup_closed=True,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+        )
+        app.ctx.gitlab_api = gidgetlab.aiohttp.GitLabAPI(
+            app.ctx.aiohttp_session,
+            requester="acts",
+            access_token=config.GITLAB_ACCESS_TOKEN,
+            url=config.GITLAB_API_URL,
+        )
 
         gh = gh_aiohttp.GitHubAPI(app.ctx.aiohttp_session, __name__)
-        jwt = get_jwt(app_id=app.config.APP_ID, private_key=app.config.PRIVATE_KEY)
-        app_info = await gh.getitem("/app", jwt=jwt)
+        app_info = await gh.getitem("/app", jwt=get_app_jwt(app))
         app.ctx.app_info = app_info
 
+        # open a pooled connection to GitLab so the first job hook does not
+        # pay for DNS and the TLS handshake. This is optional, so don't let an
+        # unreachable GitLab hold up startup.
+        try:
+            await asyncio.wait_for(
+                app.ctx.gitlab_api.getitem("/version"), timeout=GITLAB_WARMUP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out warming up GitLab connection")
+        except Exception as e:
+            logger.warning("Could not warm up GitLab connection: %s", e)
+
+        logger.debug("Starting %d webhook workers", config.MAX_CONCURRENT_WEBHOOKS)
+        app.ctx.webhook_workers = [
+            asyncio.create_task(webhook_worker())
+            for _ in range(config.MAX_CONCURRENT_WEBHOOKS)
+        ]
+
+    @app.listener("before_server_stop")
+    async def shutdown(app, loop):
+        try:
+            await asyncio.wait_for(
+                app.ctx.webhook_queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Dropping %d queued webhooks on shutdown",
+                app.ctx.webhook_queue.qsize(),
+            )
+
+        logger.debug("Stopping webhook workers")
+        for worker in app.ctx.webhook_workers:
+            worker.cancel()
+        await asyncio.gather(*app.ctx.webhook_workers, return_exceptions=True)
+
+        logger.debug("Closing aiohttp session")
+        await app.ctx.aiohttp_session.close()
+
     @app.route("/")
     async def index(request):
         logger.debug("status check")
         return response.text("ok")
 
-    @app.route("/health")
-    async def health(request):
-        if not limiter.has_capacity():
-            return response.text("Rate limited", status=429)
-        await limiter.acquire()
-
+    async def probe_github():
         gh = gh_aiohttp.GitHubAPI(app.ctx.aiohttp_session, __name__)
-
-        github_ok = False
-        gitlab_ok = False
-
-        logger.info("Checking health")
         try:
-            token = get_jwt(
-                app_id=app.config.APP_ID, private_key=app.config.PRIVATE_KEY
-            )
-            app_info = await gh.getitem("/app", jwt=token)
-            if app_info is None:
-                github_ok = False
-                logger.error("GitHub App info is None")
-            logger.info("GitHub ok")
-            github_ok = True
+            app_info = await gh.getitem("/app", jwt=get_app_jwt(app))
         except Exception as e:
             logger.error("GitHub App info failed: %s", e)
             logger.exception(e)
-            github_ok = False
+            return False
+
+        if app_info is None:
+            logger.error("GitHub App info is None")
+            return False
+        logger.info("GitHub ok")
+        return True
 
+    async def probe_gitlab():
         try:
-            gl = gidgetlab.aiohttp.GitLabAPI(
-                app.ctx.aiohttp_session,
-                requester="acts",
-                access_token=config.GITLAB_ACCESS_TOKEN,
-                url=config.GITLAB_API_URL,
+            projects = await app.ctx.gitlab_api.getitem(
+                f"/projects/{config.GITLAB_PROJECT_ID}"
             )
-            projects = await gl.getitem(f"/projects/{config.GITLAB_PROJECT_ID}")
-            if projects is None:
-                gitlab_ok = False
-                logger.error("GitLab project info is None")
-            logger.info("GitLab ok")
-            gitlab_ok = True
         except Exception as e:
             logger.error("GitLab project info failed: %s", e)
             logger.exception(e)
-            gitlab_ok = False
+            return False
+
+        if projects is None:
+            logger.error("GitLab project info is None")
+            return False
+        logger.info("GitLab ok")
+        return True
+
+    @app.route("/health")
+    async def health(request):
+        cached = app.ctx.health_cache
+        if cached is not None and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+            _, github_ok, gitlab_ok = cached
+        else:
+            if not limiter.consume():
+                return response.text("Rate limited", status=429)
+
+            logger.info("Checking health")
+            github_ok, gitlab_ok = await asyncio.gather(probe_github(), probe_gitlab())
+            app.ctx.health_cache = (time.monotonic(), github_ok, gitlab_ok)
 
         status = 200 if github_ok and gitlab_ok else 500
         github_str = "ok" if github_ok else "not ok"
@@ -112,97 +259,168 @@ def create_app():
         text = f"GitHub: {github_str}, GitLab: {gitlab_str}"
         return response.text(text, status=status)
 
-    async def handle_webhook(request):
-        if request.headers.get("X-Gitlab-Event") == "Pipeline Hook":
-            logger.debug("Received pipeline report")
-        elif request.headers.get("X-Gitlab-Event") == "Job Hook":
-            # this is a ping back!
-            logger.debug("Received job report")
-            if request.headers["X-Gitlab-Token"] != config.GITLAB_WEBHOOK_SECRET:
-                raise ValueError("Webhook has invalid token")
-
-            payload = request.json
-
-            if payload["object_kind"] != "build":
-                raise ValueError("Object is not a build")
-
-            project_id = payload["project_id"]
-            pipeline_id = payload["pipeline_id"]
-
-            pipeline, variables, project, job = await asyncio.gather(
-                gitlab.get_pipeline(
-                    project_id, pipeline_id, session=app.ctx.aiohttp_session
-                ),
-                gitlab.get_pipeline_variables(
-                    project_id, pipeline_id, session=app.ctx.aiohttp_session
-                ),
-                gitlab.get_project(project_id, session=app.ctx.aiohttp_session),
-                gitlab.get_job(
-                    project_id, payload["build_id"], session=app.ctx.aiohttp_session
-                ),
-            )
-
-            #  logger.debug("%s", pipeline)
-            #  logger.debug("%s", variables)
-
-            bridge_payload = variables["BRIDGE_PAYLOAD"]
-            signature = variables["TRIGGER_SIGNATURE"]
-
-            expected_signature = hmac.new(
-                config.TRIGGER_SECRET,
-                bridge_payload.encode(),
-                digestmod="sha512",
-            ).hexdigest()
-            if not hmac.compare_digest(expected_signature, signature):
+    async def handle_job_hook(payload):
+        project_id = payload["project_id"]
+        pipeline_id = payload["pipeline_id"]
+
+        pipeline, variables, project, job = await asyncio.gather(
+            gitlab.get_pipeline(
+                project_id, pipeline_id, session=app.ctx.aiohttp_session
+            ),
+            gitlab.get_pipeline_variables(
+                project_id, pipeline_id, session=app.ctx.aiohttp_session
+            ),
+            gitlab.get_project(project_id, session=app.ctx.aiohttp_session),
+            gitlab.get_job(
+                project_id, payload["build_id"], session=app.ctx.aiohttp_session
+            ),
+        )
+
+        #  logger.debug("%s", pipeline)
+        #  logger.debug("%s", variables)
+
+        signature = variables["TRIGGER_SIGNATURE"]
+
+        # every job of a pipeline carries the same payload, only verify and
+        # decode it once
+        payload_key = (project_id, pipeline_id, signature)
+        bridge_payload = app.ctx.bridge_payloads.get(payload_key)
+        if bridge_payload is None:
+            # encode once, both the HMAC and the JSON decode work on the bytes
+            raw_payload = variables["BRIDGE_PAYLOAD"].encode()
+
+            if not await trigger_signature.verify_async(raw_payload, signature):
                 logger.error("Signatures do not match")
-                return response.empty(400)
-
-            bridge_payload = json.loads(bridge_payload)
-
-            installation_id = bridge_payload["installation_id"]
-            logger.debug("Installation id: %s", installation_id)
-
-            gh = await client_for_installation(app, installation_id)
-
-            await handle_pipeline_status(
-                pipeline=pipeline,
-                job=job,
-                project=project,
-                repo_url=bridge_payload["repo_url"],
-                head_sha=bridge_payload["head_sha"],
-                gh=gh,
-                app=app,
-            )
-
-        else:
-            event = sansio.Event.from_http(
-                request.headers, request.body, secret=app.config.WEBHOOK_SECRET
-            )
-
-            if event.event == "ping":
-                return response.empty(200)
-
-            assert "installation" in event.data
-            installation_id = event.data["installation"]["id"]
-            logger.debug("Installation id: %s", installation_id)
-
-            gh = await client_for_installation(app, installation_id)
-
-            gl = gidgetlab.aiohttp.GitLabAPI(
-                app.ctx.aiohttp_session,
-                requester="acts",
-                access_token=config.GITLAB_ACCESS_TOKEN,
-                url=config.GITLAB_API_URL,
+                return
+
+            bridge_payload = json.loads(raw_payload)
+            app.ctx.bridge_payloads[payload_key] = bridge_payload
+
+        installation_id = bridge_payload["installation_id"]
+        logger.debug("Installation id: %s", installation_id)
+
+        gh = await client_for_installation(app, installation_id)
+
+        await handle_pipeline_status(
+            pipeline=pipeline,
+            job=job,
+            project=project,
+            repo_url=bridge_payload["repo_url"],
+            head_sha=bridge_payload["head_sha"],
+            gh=gh,
+            app=app,
+        )
+
+    async def handle_job_webhook(body: bytes):
+        payload = json.loads(body)
+
+        if payload["object_kind"] != "build":
+            raise ValueError("Object is not a build")
+
+        await coalesce(
+            app,
+            (
+                "job",
+                payload["project_id"],
+                payload["build_id"],
+                payload["build_status"],
+            ),
+            handle_job_hook,
+            payload,
+        )
+
+    async def handle_github_event(event: sansio.Event):
+        assert "installation" in event.data
+        installation_id = event.data["installation"]["id"]
+        logger.debug("Installation id: %s", installation_id)
+
+        gh = await client_for_installation(app, installation_id)
+
+        logger.debug("Dispatching event %s", event.event)
+        await app.ctx.github_router.dispatch(event, gh, app=app, gl=app.ctx.gitlab_api)
+
+    async def handle_github_delivery(event: sansio.Event):
+        # redeliveries keep their delivery id, only process one of them at a time
+        await coalesce(app, ("delivery", event.delivery_id), handle_github_event, event)
+
+    async def webhook_worker():
+        # a fixed number of workers bounds how many webhooks are processed
+        # at the same time
+        queue = app.ctx.webhook_queue
+        while True:
+            handler, arg = await queue.get()
+            try:
+                await handler(arg)
+            except Exception as e:
+                logger.error("Webhook processing failed: %s", e)
+                logger.exception(e)
+            finally:
+                queue.task_done()
+
+    def describe_job_webhook(body: bytes) -> str:
+        try:
+            payload = json.loads(body)
+            return "job hook for project {} build {} ({})".format(
+                payload["project_id"], payload["build_id"], payload["build_status"]
             )
+        except (ValueError, KeyError, TypeError):
+            return "unparseable job hook"
 
-            logger.debug("Dispatching event %s", event.event)
-            await app.ctx.github_router.dispatch(event, gh, app=app, gl=gl)
+    def enqueue(handler, arg, describe):
+        try:
+            app.ctx.webhook_queue.put_nowait((handler, arg))
+        except asyncio.QueueFull:
+            # neither GitHub nor GitLab redeliver automatically, log enough
+            # to redeliver by hand
+            logger.error("Webhook queue is full, dropping %s", describe())
+            return response.empty(503)
+        return response.empty(200)
 
     @app.route("/webhook", methods=["POST"])
     async def github(request):
         logger.debug("Webhook received")
 
-        app.add_task(handle_webhook(request))
+        # authenticate before scheduling anything, and only hand the payload
+        # to the task so the request is not kept alive after the response
+        gitlab_event = request.headers.get("X-Gitlab-Event")
+        if gitlab_event == "Pipeline Hook":
+            logger.debug("Received pipeline report")
+        elif gitlab_event == "Job Hook":
+            # this is a ping back!
+            logger.debug("Received job report")
+            token = request.headers.get("X-Gitlab-Token", "")
+            if not hmac.compare_digest(token.encode(), app.ctx.gitlab_webhook_secret):
+                logger.error("Webhook has invalid token")
+                return response.empty(401)
+
+            body = request.body
+            return enqueue(handle_job_webhook, body, lambda: describe_job_webhook(body))
+        else:
+            try:
+                event = sansio.Event.from_http(
+                    request.headers, request.body, secret=app.ctx.webhook_secret
+                )
+            except gidgethub.ValidationFailure as e:
+                logger.error("Webhook signature validation failed: %s", e)
+                return response.empty(401)
+            except (gidgethub.BadRequest, KeyError) as e:
+                # wrong content type or missing event / delivery headers
+                logger.error("Malformed webhook request: %s", e)
+                return response.empty(400)
+
+            if event.event != "ping":
+                if not is_handled_event(event):
+                    logger.debug(
+                        "Ignoring %s event with action %s",
+                        event.event,
+                        event.data.get("action"),
+                    )
+                    return response.empty(200)
+                return enqueue(
+                    handle_github_delivery,
+                    event,
+                    lambda: f"{event.event} event, delivery {event.delivery_id}",
+                )
 
         return response.empty(200)
 